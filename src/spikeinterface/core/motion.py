@@ -1,10 +1,23 @@
+import importlib.util
 import json
+import struct
+import weakref
+import zipfile
 from pathlib import Path
 
 import numpy as np
 import spikeinterface
 from spikeinterface.core.core_tools import check_json
 
+HAVE_NUMBA = importlib.util.find_spec("numba") is not None
+
+# interpolators shared by all Motion objects built on the same arrays
+# an entry lives as long as one Motion holds the interpolator
+_interpolators_cache = weakref.WeakValueDictionary()
+
+# arrays smaller than this are read in memory by Motion.load(), larger ones are memory mapped
+_memmap_min_nbytes = 16 * 1024**2
+
 
 class Motion:
     """
@@ -31,6 +44,13 @@ class Motion:
     interpolation_method : str
         How to determine the displacement between bin centers? See the docs
         for scipy.interpolate.RegularGridInterpolator for options.
+        When "linear" and numba is installed, a compiled bilinear kernel is used
+        instead of scipy.
+
+    Notes
+    -----
+    The arrays must not be modified or replaced after construction: bounds, bin steps, interpolators
+    and cached bin indices are derived from them. Create a new Motion instead.
     """
 
     def __init__(self, displacement, temporal_bins_s, spatial_bins_um, direction="y", interpolation_method="linear"):
@@ -46,14 +66,65 @@ class Motion:
         assert isinstance(spatial_bins_um, np.ndarray)
         self.spatial_bins_um = spatial_bins_um
 
+        # C-contiguous float64 arrays are required for a fast interpolation kernel
+        # this does not copy arrays that are already float64, so memory mapped arrays stay on disk
+        self.displacement = [np.ascontiguousarray(d, dtype="float64") for d in self.displacement]
+        self.temporal_bins_s = [np.ascontiguousarray(t, dtype="float64") for t in self.temporal_bins_s]
+        self.spatial_bins_um = np.ascontiguousarray(self.spatial_bins_um, dtype="float64")
+
         self.num_segments = len(self.displacement)
         self.interpolators = None
+        self._spatial_indices_cache = None
         self.interpolation_method = interpolation_method
 
         self.direction = direction
         self.dim = ["x", "y", "z"].index(direction)
         self.check_properties()
         self.temporal_bin_edges_s = [ensure_time_bin_edges(tbins) for tbins in self.temporal_bins_s]
+        self.temporal_bounds = [(t[0], t[-1]) for t in self.temporal_bins_s]
+        # bins are monotonic (as required by the interpolation), so the bounds are the first and last bins
+        self.spatial_bounds = (
+            min(self.spatial_bins_um[0], self.spatial_bins_um[-1]),
+            max(self.spatial_bins_um[0], self.spatial_bins_um[-1]),
+        )
+        # uniform bins allow a direct index computation instead of a binary search
+        self._temporal_inv_steps = np.array([get_bins_inverse_step(t) for t in self.temporal_bins_s])
+        self._spatial_inv_step = get_bins_inverse_step(self.spatial_bins_um)
+        # the bilinear kernels need increasing spatial bins, decreasing bins go through RegularGridInterpolator
+        self._increasing_spatial_bins = bool(np.all(np.diff(self.spatial_bins_um) > 0))
+
+    def _get_stacked_arrays(self, segment_index):
+        """
+        Arrays for the numba kernels: (temporal_bins_s, temporal_inv_steps, displacement, segment_index)
+        with a leading segment axis, as one segment stacks (views) of the requested segment.
+        """
+        return (
+            self.temporal_bins_s[segment_index][np.newaxis],
+            self._temporal_inv_steps[segment_index : segment_index + 1],
+            self.displacement[segment_index][np.newaxis],
+            0,
+        )
+
+    def _get_cached_spatial_indices_and_weights(self, locations_um):
+        """
+        Same as `get_bins_indices_and_weights()` on the spatial bins, but the result of the last call is
+        reused when locations_um is the same array with the same values, which is typically the case for
+        channel positions. Times change at every call, so the temporal axis is not cached.
+        """
+        key = (
+            id(self.spatial_bins_um),
+            self._spatial_inv_step,
+            locations_um.__array_interface__["data"][0],
+            locations_um.shape,
+            locations_um.strides,
+        )
+        cached = self._spatial_indices_cache
+        # the values are also compared because the array could have been modified in place
+        if cached is not None and cached[0] == key and np.array_equal(cached[1], locations_um):
+            return cached[2], cached[3]
+        indices, weights = get_bins_indices_and_weights(self.spatial_bins_um, self._spatial_inv_step, locations_um)
+        self._spatial_indices_cache = (key, locations_um.copy(), indices, weights)
+        return indices, weights
 
     def check_properties(self):
         assert all(d.ndim == 2 for d in self.displacement)
@@ -72,16 +143,12 @@ class Motion:
         return txt
 
     def make_interpolators(self):
-        from scipy.interpolate import RegularGridInterpolator
-
         self.interpolators = [
-            RegularGridInterpolator(
-                (self.temporal_bins_s[j], self.spatial_bins_um), self.displacement[j], method=self.interpolation_method
+            get_regular_grid_interpolator(
+                self.temporal_bins_s[j], self.spatial_bins_um, self.displacement[j], self.interpolation_method
             )
             for j in range(self.num_segments)
         ]
-        self.temporal_bounds = [(t[0], t[-1]) for t in self.temporal_bins_s]
-        self.spatial_bounds = (self.spatial_bins_um.min(), self.spatial_bins_um.max())
 
     def get_displacement_at_time_and_depth(self, times_s, locations_um, segment_index=None, grid=False):
         """Evaluate the motion estimate at times and positions
@@ -110,17 +177,14 @@ class Motion:
             A displacement per input location, of shape times_s.shape if grid=False and (locations_um.size, times_s.size)
             if grid=True.
         """
-        if self.interpolators is None:
-            self.make_interpolators()
-
         if segment_index is None:
             if self.num_segments == 1:
                 segment_index = 0
             else:
                 raise ValueError("Several segment need segment_index=")
 
-        times_s = np.asarray(times_s)
-        locations_um = np.asarray(locations_um)
+        times_s = np.asarray(times_s, dtype="float64")
+        locations_um = np.asarray(locations_um, dtype="float64")
 
         if locations_um.ndim == 1:
             locations_um = locations_um
@@ -129,6 +193,101 @@ class Motion:
         else:
             assert False
 
+        if not grid:
+            # usual case: input is a point cloud
+            assert locations_um.shape == times_s.shape
+            assert times_s.ndim == 1
+
+        if self.interpolation_method == "linear" and self.spatial_bins_um.shape[0] == 1:
+            # rigid motion: bilinear interpolation reduces to a linear interpolation in time
+            if HAVE_NUMBA:
+                temporal_bins_s, temporal_inv_steps, displacement_stack, stack_index = self._get_stacked_arrays(
+                    segment_index
+                )
+                displacement = np.empty(times_s.shape, dtype="float64")
+                get_numba_motion_kernels()["linear_time_eval"](
+                    temporal_bins_s, temporal_inv_steps, displacement_stack, stack_index, times_s, displacement
+                )
+            else:
+                # np.interp clips to the border values
+                displacement = np.interp(
+                    times_s, self.temporal_bins_s[segment_index], self.displacement[segment_index][:, 0]
+                )
+            if grid:
+                displacement = np.repeat(displacement[np.newaxis, :], locations_um.size, axis=0)
+            return displacement
+
+        if self.interpolation_method == "linear" and self._increasing_spatial_bins and HAVE_NUMBA:
+            # times and locations are clipped to the bounds inside the kernel, avoiding temporary arrays
+            kernels = get_numba_motion_kernels()
+            temporal_bins_s, temporal_inv_steps, displacement_stack, stack_index = self._get_stacked_arrays(
+                segment_index
+            )
+            if grid:
+                # indices and weights are computed once per time and per location, then the kernel
+                # loops over the grid directly, no meshgrid is needed
+                temporal_indices, temporal_weights = get_bins_indices_and_weights(
+                    temporal_bins_s[stack_index], temporal_inv_steps[stack_index], times_s
+                )
+                spatial_indices, spatial_weights = self._get_cached_spatial_indices_and_weights(locations_um)
+                displacement = np.empty((locations_um.size, times_s.size), dtype="float64")
+                kernels["bilinear_grid_eval"](
+                    displacement_stack,
+                    stack_index,
+                    temporal_indices,
+                    temporal_weights,
+                    spatial_indices,
+                    spatial_weights,
+                    displacement,
+                )
+            else:
+                displacement = np.empty(times_s.shape, dtype="float64")
+                kernels["bilinear_eval"](
+                    temporal_bins_s,
+                    temporal_inv_steps,
+                    self.spatial_bins_um,
+                    self._spatial_inv_step,
+                    displacement_stack,
+                    stack_index,
+                    times_s,
+                    locations_um,
+                    displacement,
+                )
+            return displacement
+
+        if self.interpolation_method == "linear" and self._increasing_spatial_bins and self.interpolators is None:
+            # no numba: bilinear interpolation with numpy from the indices and weights of each axis
+            # this avoids constructing RegularGridInterpolator objects (scipy interpn() also builds one)
+            # interpolators are used only when explicitly made with make_interpolators()
+            temporal_args = (
+                self.temporal_bins_s[segment_index],
+                self._temporal_inv_steps[segment_index],
+                times_s,
+            )
+            spatial_args = (self.spatial_bins_um, self._spatial_inv_step, locations_um)
+            if grid:
+                temporal_indices, temporal_weights = get_bins_indices_and_weights(*temporal_args)
+                spatial_indices, spatial_weights = self._get_cached_spatial_indices_and_weights(locations_um)
+                # shape (locations, times)
+                temporal_indices = temporal_indices[np.newaxis, :, :]
+                temporal_weights = temporal_weights[np.newaxis, :, :]
+                spatial_indices = spatial_indices[:, np.newaxis, :]
+                spatial_weights = spatial_weights[:, np.newaxis, :]
+            else:
+                temporal_indices, temporal_weights = get_bins_indices_and_weights(*temporal_args)
+                spatial_indices, spatial_weights = get_bins_indices_and_weights(*spatial_args)
+            segment_displacement = self.displacement[segment_index]
+            displacement = 0.0
+            for a in range(2):
+                for b in range(2):
+                    displacement = (
+                        displacement
+                        + temporal_weights[..., a]
+                        * spatial_weights[..., b]
+                        * segment_displacement[temporal_indices[..., a], spatial_indices[..., b]]
+                    )
+            return displacement
+
         times_s = times_s.clip(*self.temporal_bounds[segment_index])
         locations_um = locations_um.clip(*self.spatial_bounds)
 
@@ -139,11 +298,10 @@ class Motion:
             locations_um = locations_um.ravel()
             times_s = times_s.ravel()
         else:
-            # usual case: input is a point cloud
-            assert locations_um.shape == times_s.shape
-            assert times_s.ndim == 1
             out_shape = times_s.shape
 
+        if self.interpolators is None:
+            self.make_interpolators()
         points = np.column_stack((times_s, locations_um))
         displacement = self.interpolators[segment_index](points)
         # reshape to grid domain shape if necessary
@@ -171,6 +329,79 @@ class Motion:
             interpolation_method=d["interpolation_method"],
         )
 
+    def get_displacement_at_time_and_depth_all_segments(self, times_s, locations_um, segment_indices):
+        """Evaluate the motion estimate at times and positions belonging to several segments
+
+        This is equivalent to calling `get_displacement_at_time_and_depth()` for each segment on the
+        points of this segment, but with linear interpolation the points of all segments are
+        evaluated in one call when all segments have the same shape (the segments are then copied
+        in one stacked array, except memory mapped segments which are evaluated one at a time).
+
+        Parameters
+        ----------
+        times_s: np.array
+        locations_um: np.array
+            Either this is a one-dimensional array (a vector of positions along self.dimension), or
+            else a 2d array with the 2 or 3 spatial dimensions indexed along axis=1.
+        segment_indices: np.array
+            The segment index of each point, same shape as times_s.
+
+        Returns
+        -------
+        displacement : np.array
+            A displacement per input location, of shape times_s.shape.
+        """
+        times_s = np.asarray(times_s, dtype="float64")
+        locations_um = np.asarray(locations_um, dtype="float64")
+        segment_indices = np.asarray(segment_indices, dtype="int64")
+
+        if locations_um.ndim == 2:
+            locations_um = locations_um[:, self.dim]
+        assert times_s.ndim == 1
+        assert locations_um.shape == times_s.shape
+        assert segment_indices.shape == times_s.shape
+
+        if segment_indices.size > 0 and (segment_indices.min() < 0 or segment_indices.max() >= self.num_segments):
+            raise ValueError(f"segment_indices must be in [0, {self.num_segments})")
+
+        if (
+            self.interpolation_method == "linear"
+            and self._increasing_spatial_bins
+            and HAVE_NUMBA
+            and all(d.shape == self.displacement[0].shape for d in self.displacement)
+            and not any(_is_memmap(d) for d in self.displacement)
+        ):
+            # segments are stacked in one (num_segments, temporal bins, spatial bins) array for a single
+            # kernel call, memory mapped segments are not stacked because this would load them in memory
+            if self.num_segments == 1:
+                temporal_bins_stack = self.temporal_bins_s[0][np.newaxis]
+                displacement_stack = self.displacement[0][np.newaxis]
+            else:
+                temporal_bins_stack = np.stack(self.temporal_bins_s)
+                displacement_stack = np.stack(self.displacement)
+            displacement = np.empty(times_s.shape, dtype="float64")
+            get_numba_motion_kernels()["bilinear_eval_segments"](
+                temporal_bins_stack,
+                self._temporal_inv_steps,
+                self.spatial_bins_um,
+                self._spatial_inv_step,
+                displacement_stack,
+                segment_indices,
+                times_s,
+                locations_um,
+                displacement,
+            )
+            return displacement
+
+        # segments cannot be stacked or other methods: one call per segment
+        displacement = np.empty(times_s.shape, dtype="float64")
+        for segment_index in np.unique(segment_indices):
+            mask = segment_indices == segment_index
+            displacement[mask] = self.get_displacement_at_time_and_depth(
+                times_s[mask], locations_um[mask], segment_index=int(segment_index)
+            )
+        return displacement
+
     def save(self, folder):
         folder = Path(folder)
         folder.mkdir(exist_ok=False, parents=True)
@@ -180,6 +411,7 @@ class Motion:
             version=spikeinterface.__version__,
             dev_mode=spikeinterface.DEV_MODE,
             object="Motion",
+            format_version=2,
             num_segments=self.num_segments,
             direction=self.direction,
             interpolation_method=self.interpolation_method,
@@ -187,14 +419,23 @@ class Motion:
         with open(info_file, mode="w") as f:
             json.dump(check_json(info), f, indent=4)
 
-        np.save(folder / "spatial_bins_um.npy", self.spatial_bins_um)
-
+        # all arrays in one uncompressed npz, which can still be memory mapped at load time
+        arrays = dict(spatial_bins_um=self.spatial_bins_um)
         for segment_index in range(self.num_segments):
-            np.save(folder / f"displacement_seg{segment_index}.npy", self.displacement[segment_index])
-            np.save(folder / f"temporal_bins_s_seg{segment_index}.npy", self.temporal_bins_s[segment_index])
+            arrays[f"displacement_seg{segment_index}"] = self.displacement[segment_index]
+            arrays[f"temporal_bins_s_seg{segment_index}"] = self.temporal_bins_s[segment_index]
+        np.savez(folder / "motion.npz", **arrays)
 
     @classmethod
     def load(cls, folder):
+        """
+        Load a Motion saved with `Motion.save()`.
+
+        Large displacement and temporal bins arrays (more than 16 MiB) are memory mapped in
+        read-only mode: the file stays open while the Motion is alive, so the folder cannot be
+        removed or overwritten on Windows in the meantime. Use `motion.copy()` to get in-memory
+        writable arrays. Smaller arrays are read in memory.
+        """
         folder = Path(folder)
 
         info_file = folder / f"spikeinterface_info.json"
@@ -209,12 +450,32 @@ class Motion:
 
         direction = info["direction"]
         interpolation_method = info["interpolation_method"]
-        spatial_bins_um = np.load(folder / "spatial_bins_um.npy")
+
+        # format 1 (no format_version, spikeinterface <= 0.102): one npy file per array
+        # format 2: all arrays in one uncompressed motion.npz
+        # large arrays are memory mapped: only the parts that are evaluated are read from disk
+        format_version = info.get("format_version", 1)
+        if format_version == 2:
+            arrays = _memmap_npz(folder / "motion.npz")
+        elif format_version == 1:
+            arrays = {}
+            for file in folder.glob("*.npy"):
+                arr = np.load(file, mmap_mode="r")
+                if arr.nbytes < _memmap_min_nbytes:
+                    arr = np.array(arr)
+                arrays[file.stem] = arr
+        else:
+            raise IOError(
+                f"Motion.load(folder): unknown format_version={format_version} in {info_file}, "
+                "it was probably saved by a more recent spikeinterface version."
+            )
+
+        spatial_bins_um = np.array(arrays["spatial_bins_um"])
         displacement = []
         temporal_bins_s = []
         for segment_index in range(info["num_segments"]):
-            displacement.append(np.load(folder / f"displacement_seg{segment_index}.npy"))
-            temporal_bins_s.append(np.load(folder / f"temporal_bins_s_seg{segment_index}.npy"))
+            displacement.append(arrays[f"displacement_seg{segment_index}"])
+            temporal_bins_s.append(arrays[f"temporal_bins_s_seg{segment_index}"])
 
         return cls(
             displacement,
@@ -226,17 +487,21 @@ class Motion:
 
     def __eq__(self, other):
         for segment_index in range(self.num_segments):
-            if not np.allclose(self.displacement[segment_index], other.displacement[segment_index]):
+            if not _arrays_close(self.displacement[segment_index], other.displacement[segment_index]):
                 return False
-            if not np.allclose(self.temporal_bins_s[segment_index], other.temporal_bins_s[segment_index]):
+            if not _arrays_close(self.temporal_bins_s[segment_index], other.temporal_bins_s[segment_index]):
                 return False
 
-        if not np.allclose(self.spatial_bins_um, other.spatial_bins_um):
+        if not _arrays_close(self.spatial_bins_um, other.spatial_bins_um):
             return False
 
         return True
 
     def copy(self):
+        """
+        Deep copy: the arrays of the copy are new in-memory, writable, C-contiguous float64 arrays
+        (also when the arrays of this Motion are memory mapped).
+        """
         return Motion(
             [d.copy() for d in self.displacement],
             [t.copy() for t in self.temporal_bins_s],
@@ -254,6 +519,59 @@ class Motion:
         return min_, max_
 
 
+def _arrays_close(a, b):
+    """
+    Same as np.allclose() but with a fast path for identical arrays (the usual case after a load or a copy).
+    """
+    if a.shape == b.shape and a.dtype == b.dtype and np.array_equal(a, b):
+        return True
+    return np.allclose(a, b)
+
+
+def _is_memmap(arr):
+    """
+    True if the array is a np.memmap or a view on one.
+    """
+    while isinstance(arr, np.ndarray):
+        if isinstance(arr, np.memmap):
+            return True
+        arr = arr.base
+    return False
+
+
+def _memmap_npz(npz_file):
+    """
+    Memory map (read-only) the arrays of an uncompressed npz file.
+    Arrays smaller than `_memmap_min_nbytes` are read in memory (writable).
+
+    np.load() ignores mmap_mode for npz files. Members of an uncompressed
+    npz are plain npy files stored contiguously inside the zip, so they can be
+    memory mapped directly at their offset.
+    """
+    arrays = {}
+    with zipfile.ZipFile(npz_file) as zf, open(npz_file, "rb") as f:
+        for zinfo in zf.infolist():
+            if zinfo.compress_type != zipfile.ZIP_STORED:
+                raise ValueError(f"{npz_file} is compressed and cannot be memory mapped")
+            # skip the local file header, its extra field can differ from the central directory one
+            f.seek(zinfo.header_offset + 26)
+            name_length, extra_length = struct.unpack("<HH", f.read(4))
+            f.seek(zinfo.header_offset + 30 + name_length + extra_length)
+            name = zinfo.filename[: -len(".npy")]
+            if zinfo.file_size < _memmap_min_nbytes:
+                arrays[name] = np.lib.format.read_array(f)
+                continue
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            arrays[name] = np.memmap(
+                npz_file, dtype=dtype, mode="r", shape=shape, order="F" if fortran_order else "C", offset=f.tell()
+            )
+    return arrays
+
+
 def ensure_time_bins(time_bin_centers_s=None, time_bin_edges_s=None):
     """Ensure that both bin edges and bin centers are present
 
@@ -309,3 +627,233 @@ def ensure_time_bins(time_bin_centers_s=None, time_bin_edges_s=None):
 
 def ensure_time_bin_edges(time_bin_centers_s=None, time_bin_edges_s=None):
     return ensure_time_bins(time_bin_centers_s, time_bin_edges_s)[1]
+
+
+def get_regular_grid_interpolator(temporal_bins_s, spatial_bins_um, displacement, method):
+    """
+    Get a scipy RegularGridInterpolator for one segment.
+
+    Interpolators are cached by the identity of the input arrays, so Motion objects
+    sharing the same arrays (for instance after `Motion.from_dict(motion.to_dict())`)
+    do not construct them again.
+    """
+    from scipy.interpolate import RegularGridInterpolator
+
+    key = (id(temporal_bins_s), id(spatial_bins_um), id(displacement), method)
+    interpolator = _interpolators_cache.get(key)
+    # the interpolator keeps references on the arrays, so the id cannot be reused while it is cached
+    if (
+        interpolator is None
+        or interpolator.grid[0] is not temporal_bins_s
+        or interpolator.grid[1] is not spatial_bins_um
+        or interpolator.values is not displacement
+    ):
+        interpolator = RegularGridInterpolator((temporal_bins_s, spatial_bins_um), displacement, method=method)
+        _interpolators_cache[key] = interpolator
+    return interpolator
+
+
+def get_bins_inverse_step(bins):
+    """
+    Inverse of the step between bins when bins are uniformly spaced, 0 otherwise.
+
+    Parameters
+    ----------
+    bins : np.array
+        1d array of sorted bin centers
+
+    Returns
+    -------
+    inv_step : float
+        1 / (bins[1] - bins[0]) if bins are uniform else 0.
+    """
+    if bins.size < 2:
+        return 0.0
+    step = bins[1] - bins[0]
+    if step > 0 and np.allclose(np.diff(bins), step, rtol=1e-9, atol=0):
+        return float(1.0 / step)
+    return 0.0
+
+
+def get_bins_indices_and_weights(bins, inv_step, x):
+    """
+    Left/right bin indices and linear interpolation weights of positions along one axis.
+
+    Parameters
+    ----------
+    bins : np.array
+        1d array of sorted bin centers
+    inv_step : float
+        Inverse of the bins step when bins are uniform, 0 otherwise (see `get_bins_inverse_step()`)
+    x : np.array
+        1d array of float64 positions, they are clipped to the bins bounds
+
+    Returns
+    -------
+    indices : np.array
+        (x.size, 2) int64 array of the left and right bin of each position
+    weights : np.array
+        (x.size, 2) float64 array of the weights of the left and right bin
+    """
+    indices = np.empty((x.size, 2), dtype="int64")
+    weights = np.empty((x.size, 2), dtype="float64")
+    if HAVE_NUMBA:
+        get_numba_motion_kernels()["bins_indices_and_weights"](bins, inv_step, x, indices, weights)
+        return indices, weights
+
+    n = bins.size
+    if n == 1:
+        indices[:] = 0
+        weights[:, 0] = 1.0
+        weights[:, 1] = 0.0
+        return indices, weights
+    x = np.clip(x, bins[0], bins[-1])
+    i0 = np.clip(np.searchsorted(bins, x, side="right") - 1, 0, n - 2)
+    w = (x - bins[i0]) / (bins[i0 + 1] - bins[i0])
+    indices[:, 0] = i0
+    indices[:, 1] = i0 + 1
+    weights[:, 0] = 1.0 - w
+    weights[:, 1] = w
+    return indices, weights
+
+
+def get_numba_motion_kernels():
+    """
+    Get the numba kernels that evaluate the bilinear interpolation of one segment of a displacement array.
+
+    Displacement is given as (num_segments, temporal bins, spatial bins) array and temporal bins as
+    (num_segments, temporal bins) array along with the segment_index to evaluate.
+
+    Returns a dict with:
+      * "bins_indices_and_weights": left/right bin indices and weights along one axis, see
+        `get_bins_indices_and_weights()`
+      * "bilinear_eval": evaluation at a point cloud of (time, depth), out.shape = times_s.shape
+      * "bilinear_grid_eval": evaluation on the grid of depths x times from the indices and weights of
+        each axis, out.shape = (locations_um.size, times_s.size)
+      * "linear_time_eval": evaluation for rigid motion (one spatial bin) at times, out.shape = times_s.shape
+      * "bilinear_eval_segments": evaluation at a point cloud of (time, depth) where each point has
+        its own segment index, out.shape = times_s.shape
+
+    The kernels are equivalent to scipy.interpolate.RegularGridInterpolator with method="linear"
+    after clipping the points to the grid bounds, which is done inside the kernels.
+    When the bins of an axis are uniform (inv_step > 0), the index on this axis is computed
+    directly with a multiply and a floor instead of using a binary search.
+    The kernels are not parallel: they are called per chunk on a few hundred channels, possibly
+    from several threads at once, which numba's workqueue threading layer does not support.
+    The compiled functions are cached.
+    """
+    if hasattr(get_numba_motion_kernels, "_cached_numba_functions"):
+        return get_numba_motion_kernels._cached_numba_functions
+
+    import numba
+
+    @numba.jit(nopython=True, nogil=True, cache=True)
+    def find_bin_index_and_weight(bins, inv_step, x):
+        # left bin index and weight of the right bin
+        n = bins.size
+        if n == 1:
+            return 0, 0, 0.0
+        x = min(max(x, bins[0]), bins[n - 1])
+        if inv_step > 0.0:
+            i0 = int((x - bins[0]) * inv_step)
+        else:
+            i0 = np.searchsorted(bins, x, side="right") - 1
+        i0 = min(max(i0, 0), n - 2)
+        w = (x - bins[i0]) / (bins[i0 + 1] - bins[i0])
+        return i0, i0 + 1, w
+
+    @numba.jit(nopython=True, nogil=True, cache=True, fastmath=True)
+    def bilinear_eval_numba(
+        temporal_bins_s,
+        temporal_inv_steps,
+        spatial_bins_um,
+        spatial_inv_step,
+        displacement,
+        segment_index,
+        times_s,
+        locations_um,
+        out,
+    ):
+        segment_temporal_bins_s = temporal_bins_s[segment_index]
+        temporal_inv_step = temporal_inv_steps[segment_index]
+        for i in range(times_s.size):
+            it0, it1, wt = find_bin_index_and_weight(segment_temporal_bins_s, temporal_inv_step, times_s[i])
+            is0, is1, ws = find_bin_index_and_weight(spatial_bins_um, spatial_inv_step, locations_um[i])
+            out[i] = (
+                (1.0 - wt) * (1.0 - ws) * displacement[segment_index, it0, is0]
+                + wt * (1.0 - ws) * displacement[segment_index, it1, is0]
+                + (1.0 - wt) * ws * displacement[segment_index, it0, is1]
+                + wt * ws * displacement[segment_index, it1, is1]
+            )
+
+    @numba.jit(nopython=True, nogil=True, cache=True)
+    def bins_indices_and_weights_numba(bins, inv_step, x, indices, weights):
+        # indices.shape = weights.shape = (x.size, 2) : left/right bin and their weights
+        for i in range(x.size):
+            i0, i1, w = find_bin_index_and_weight(bins, inv_step, x[i])
+            indices[i, 0] = i0
+            indices[i, 1] = i1
+            weights[i, 0] = 1.0 - w
+            weights[i, 1] = w
+
+    @numba.jit(nopython=True, nogil=True, cache=True, fastmath=True)
+    def bilinear_grid_eval_numba(
+        displacement, segment_index, temporal_indices, temporal_weights, spatial_indices, spatial_weights, out
+    ):
+        for i in range(spatial_indices.shape[0]):
+            is0 = spatial_indices[i, 0]
+            is1 = spatial_indices[i, 1]
+            ws0 = spatial_weights[i, 0]
+            ws1 = spatial_weights[i, 1]
+            for j in range(temporal_indices.shape[0]):
+                it0 = temporal_indices[j, 0]
+                it1 = temporal_indices[j, 1]
+                wt0 = temporal_weights[j, 0]
+                wt1 = temporal_weights[j, 1]
+                out[i, j] = ws0 * (
+                    wt0 * displacement[segment_index, it0, is0] + wt1 * displacement[segment_index, it1, is0]
+                ) + ws1 * (wt0 * displacement[segment_index, it0, is1] + wt1 * displacement[segment_index, it1, is1])
+
+    @numba.jit(nopython=True, nogil=True, cache=True, fastmath=True)
+    def linear_time_eval_numba(temporal_bins_s, temporal_inv_steps, displacement, segment_index, times_s, out):
+        # rigid motion: only one spatial bin
+        segment_temporal_bins_s = temporal_bins_s[segment_index]
+        temporal_inv_step = temporal_inv_steps[segment_index]
+        for i in range(times_s.size):
+            it0, it1, wt = find_bin_index_and_weight(segment_temporal_bins_s, temporal_inv_step, times_s[i])
+            out[i] = (1.0 - wt) * displacement[segment_index, it0, 0] + wt * displacement[segment_index, it1, 0]
+
+    @numba.jit(nopython=True, nogil=True, cache=True, fastmath=True)
+    def bilinear_eval_segments_numba(
+        temporal_bins_s,
+        temporal_inv_steps,
+        spatial_bins_um,
+        spatial_inv_step,
+        displacement,
+        segment_indices,
+        times_s,
+        locations_um,
+        out,
+    ):
+        # same as bilinear_eval_numba but with one segment index per point
+        for i in range(times_s.size):
+            k = segment_indices[i]
+            it0, it1, wt = find_bin_index_and_weight(temporal_bins_s[k], temporal_inv_steps[k], times_s[i])
+            is0, is1, ws = find_bin_index_and_weight(spatial_bins_um, spatial_inv_step, locations_um[i])
+            out[i] = (
+                (1.0 - wt) * (1.0 - ws) * displacement[k, it0, is0]
+                + wt * (1.0 - ws) * displacement[k, it1, is0]
+                + (1.0 - wt) * ws * displacement[k, it0, is1]
+                + wt * ws * displacement[k, it1, is1]
+            )
+
+    # Cache the compiled functions
+    get_numba_motion_kernels._cached_numba_functions = dict(
+        bins_indices_and_weights=bins_indices_and_weights_numba,
+        bilinear_eval=bilinear_eval_numba,
+        bilinear_grid_eval=bilinear_grid_eval_numba,
+        linear_time_eval=linear_time_eval_numba,
+        bilinear_eval_segments=bilinear_eval_segments_numba,
+    )
+
+    return get_numba_motion_kernels._cached_numba_functions
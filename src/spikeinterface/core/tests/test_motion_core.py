@@ -1,8 +1,12 @@
+import json
 import pickle
 import shutil
 
 import numpy as np
-from spikeinterface.core.motion import Motion
+import pytest
+
+import spikeinterface.core.motion
+from spikeinterface.core.motion import Motion, HAVE_NUMBA, _is_memmap
 from spikeinterface.generation import make_one_displacement_vector
 
 
@@ -29,7 +33,7 @@ def make_fake_motion():
     return motion
 
 
-def test_motion_object(tmp_path):
+def test_motion_object(tmp_path, monkeypatch):
     """Basic tests for Motion object representation, saving and loading."""
     temporal_bins_s = np.arange(0.0, 10.0, 1.0)
     spatial_bins_um = np.array([100.0, 200.0])
@@ -49,6 +53,217 @@ def test_motion_object(tmp_path):
     motion.save(folder)
     motion2 = Motion.load(folder)
     assert motion == motion2
+    # small arrays are read in memory, so the file is not kept open
+    assert motion2.displacement[0].flags.writeable
+    assert not _is_memmap(motion2.displacement[0])
+    # large arrays are memory mapped
+    monkeypatch.setattr(spikeinterface.core.motion, "_memmap_min_nbytes", 0)
+    motion2 = Motion.load(folder)
+    assert motion == motion2
+    assert not motion2.displacement[0].flags.writeable
+    assert _is_memmap(motion2.displacement[0])
+    np.testing.assert_array_equal(
+        motion.get_displacement_at_time_and_depth([2.5, 5.0], [120.0, 180.0]),
+        motion2.get_displacement_at_time_and_depth([2.5, 5.0], [120.0, 180.0]),
+    )
+
+    # copy is deep and writable
+    motion3 = motion2.copy()
+    assert motion3 == motion2
+    motion3.displacement[0] += 1.0
+    assert not np.shares_memory(motion3.displacement[0], motion2.displacement[0])
+    assert motion3 != motion2
+
+    # old format with one npy file per array
+    folder = tmp_path / "motion_saved_npy"
+    shutil.copytree(tmp_path / "motion_saved", folder, ignore=shutil.ignore_patterns("*.npz"))
+    for name, arr in np.load(tmp_path / "motion_saved" / "motion.npz").items():
+        np.save(folder / f"{name}.npy", arr)
+    info_file = folder / "spikeinterface_info.json"
+    info = json.loads(info_file.read_text())
+    assert info.pop("format_version") == 2
+    info_file.write_text(json.dumps(info))
+    motion2 = Motion.load(folder)
+    assert motion == motion2
+    assert _is_memmap(motion2.displacement[0])
+
+    # unknown format
+    info["format_version"] = 3
+    info_file.write_text(json.dumps(info))
+    with pytest.raises(IOError):
+        Motion.load(folder)
+
+    # compressed npz cannot be memory mapped
+    folder = tmp_path / "motion_saved_compressed"
+    shutil.copytree(tmp_path / "motion_saved", folder)
+    np.savez_compressed(folder / "motion.npz", **np.load(tmp_path / "motion_saved" / "motion.npz"))
+    with pytest.raises(ValueError):
+        Motion.load(folder)
+    monkeypatch.undo()
+
+    # interpolators are shared between Motion objects built on the same arrays
+    motion.make_interpolators()
+    motion2 = Motion.from_dict(motion.to_dict())
+    motion2.make_interpolators()
+    assert motion2.interpolators[0] is motion.interpolators[0]
+
+
+@pytest.mark.skipif(not HAVE_NUMBA, reason="Numba not available")
+def test_motion_numba_interpolation():
+    """The numba bilinear kernel must match scipy RegularGridInterpolator."""
+    motion = make_fake_motion()
+    motion.make_interpolators()
+
+    rng = np.random.default_rng(seed=0)
+    times_s = rng.uniform(-1.0, 55.0, size=1000)
+    locations_um = rng.uniform(50.0, 450.0, size=1000)
+
+    displacement = motion.get_displacement_at_time_and_depth(times_s, locations_um)
+    points = np.column_stack((times_s.clip(*motion.temporal_bounds[0]), locations_um.clip(*motion.spatial_bounds)))
+    expected = motion.interpolators[0](points)
+    np.testing.assert_allclose(displacement, expected, rtol=0, atol=1e-10)
+
+    # non uniform temporal bins
+    temporal_bins_s = motion.temporal_bins_s[0] ** 1.2
+    irregular_motion = Motion(motion.displacement[0], temporal_bins_s, motion.spatial_bins_um, direction="y")
+    irregular_motion.make_interpolators()
+    displacement = irregular_motion.get_displacement_at_time_and_depth(times_s, locations_um)
+    points[:, 0] = times_s.clip(*irregular_motion.temporal_bounds[0])
+    expected = irregular_motion.interpolators[0](points)
+    np.testing.assert_allclose(displacement, expected, rtol=0, atol=1e-10)
+
+    # grid
+    displacement = motion.get_displacement_at_time_and_depth(times_s[:20], locations_um[:10], grid=True)
+    assert displacement.shape == (10, 20)
+    locs, times = np.meshgrid(locations_um[:10], times_s[:20], indexing="ij")
+    expected = motion.get_displacement_at_time_and_depth(times.ravel(), locs.ravel()).reshape(10, 20)
+    np.testing.assert_allclose(displacement, expected, rtol=0, atol=1e-10)
+    # indices and weights are reused for the same locations, but not when values changed in place
+    locs = locations_um[:10].copy()
+    displacement = motion.get_displacement_at_time_and_depth(times_s[:20], locs, grid=True)
+    np.testing.assert_array_equal(
+        displacement, motion.get_displacement_at_time_and_depth(times_s[:20], locs, grid=True)
+    )
+    locs += 10.0
+    displacement = motion.get_displacement_at_time_and_depth(times_s[:20], locs, grid=True)
+    expected = motion.get_displacement_at_time_and_depth(times_s[:20], locs.copy(), grid=True)
+    np.testing.assert_array_equal(displacement, expected)
+
+    # rigid
+    rigid_motion = Motion(
+        motion.displacement[0][:, :1], motion.temporal_bins_s[0], motion.spatial_bins_um[:1], direction="y"
+    )
+    rigid_motion.make_interpolators()
+    displacement = rigid_motion.get_displacement_at_time_and_depth(times_s, locations_um)
+    points = np.column_stack((times_s.clip(*motion.temporal_bounds[0]), np.full(times_s.size, 100.0)))
+    expected = rigid_motion.interpolators[0](points)
+    np.testing.assert_allclose(displacement, expected, rtol=0, atol=1e-10)
+
+
+def test_motion_numpy_interpolation(monkeypatch):
+    """Without numba, linear interpolation is computed with numpy and must match scipy."""
+    monkeypatch.setattr(spikeinterface.core.motion, "HAVE_NUMBA", False)
+    motion = make_fake_motion()
+
+    rng = np.random.default_rng(seed=0)
+    times_s = rng.uniform(-1.0, 55.0, size=1000)
+    locations_um = rng.uniform(50.0, 450.0, size=1000)
+
+    displacement = motion.get_displacement_at_time_and_depth(times_s, locations_um)
+    grid_displacement = motion.get_displacement_at_time_and_depth(times_s[:20], locations_um[:10], grid=True)
+    # no interpolators are needed for linear
+    assert motion.interpolators is None
+
+    motion.make_interpolators()
+    expected = motion.get_displacement_at_time_and_depth(times_s, locations_um)
+    np.testing.assert_allclose(displacement, expected, rtol=0, atol=1e-10)
+    expected = motion.get_displacement_at_time_and_depth(times_s[:20], locations_um[:10], grid=True)
+    np.testing.assert_allclose(grid_displacement, expected, rtol=0, atol=1e-10)
+
+
+def test_motion_decreasing_spatial_bins(monkeypatch):
+    """Decreasing spatial bins give the same displacement as increasing ones."""
+    motion = make_fake_motion()
+    flipped_motion = Motion(
+        motion.displacement[0][:, ::-1], motion.temporal_bins_s[0], motion.spatial_bins_um[::-1], direction="y"
+    )
+
+    rng = np.random.default_rng(seed=0)
+    times_s = rng.uniform(-1.0, 55.0, size=1000)
+    locations_um = rng.uniform(50.0, 450.0, size=1000)
+
+    for have_numba in (HAVE_NUMBA, False):
+        monkeypatch.setattr(spikeinterface.core.motion, "HAVE_NUMBA", have_numba)
+        np.testing.assert_allclose(
+            flipped_motion.get_displacement_at_time_and_depth(times_s, locations_um),
+            motion.get_displacement_at_time_and_depth(times_s, locations_um),
+            rtol=0,
+            atol=1e-10,
+        )
+        np.testing.assert_allclose(
+            flipped_motion.get_displacement_at_time_and_depth(times_s[:20], locations_um[:10], grid=True),
+            motion.get_displacement_at_time_and_depth(times_s[:20], locations_um[:10], grid=True),
+            rtol=0,
+            atol=1e-10,
+        )
+
+
+def test_motion_multi_segment(tmp_path, monkeypatch):
+    motion = make_fake_motion()
+    displacement = motion.displacement[0]
+    temporal_bins_s = motion.temporal_bins_s[0]
+    times_s = np.linspace(0.0, 50.0, 30)
+    locations_um = np.linspace(100.0, 400.0, 30)
+
+    # segments keep the input arrays
+    displacement1 = -displacement
+    multi_motion = Motion(
+        [displacement, displacement1], [temporal_bins_s, temporal_bins_s + 5.0], motion.spatial_bins_um
+    )
+    assert multi_motion.displacement[1] is displacement1
+    disp0 = multi_motion.get_displacement_at_time_and_depth(times_s, locations_um, segment_index=0)
+    disp1 = multi_motion.get_displacement_at_time_and_depth(times_s + 5.0, locations_um, segment_index=1)
+    np.testing.assert_allclose(disp0, motion.get_displacement_at_time_and_depth(times_s, locations_um))
+    np.testing.assert_allclose(disp1, -disp0)
+    # all segments evaluated in one call
+    segment_indices = np.arange(times_s.size) % 2
+    disp_all = multi_motion.get_displacement_at_time_and_depth_all_segments(
+        times_s + 5.0 * segment_indices, locations_um, segment_indices
+    )
+    np.testing.assert_allclose(disp_all, np.where(segment_indices == 0, disp0, disp1), rtol=0, atol=1e-10)
+
+    # memory mapped segments (evaluated one at a time)
+    multi_motion.save(tmp_path / "multi_motion")
+    monkeypatch.setattr(spikeinterface.core.motion, "_memmap_min_nbytes", 0)
+    loaded_motion = Motion.load(tmp_path / "multi_motion")
+    monkeypatch.undo()
+    assert not loaded_motion.displacement[1].flags.writeable
+    np.testing.assert_allclose(
+        loaded_motion.get_displacement_at_time_and_depth_all_segments(
+            times_s + 5.0 * segment_indices, locations_um, segment_indices
+        ),
+        disp_all,
+    )
+
+    # interpolators are shared between multi-segment Motion objects built on the same arrays
+    multi_motion = Motion(
+        [displacement, displacement1], [temporal_bins_s] * 2, motion.spatial_bins_um, interpolation_method="nearest"
+    )
+    multi_motion.make_interpolators()
+    multi_motion2 = Motion.from_dict(multi_motion.to_dict())
+    multi_motion2.make_interpolators()
+    assert multi_motion2.interpolators[0] is multi_motion.interpolators[0]
+
+    # different shapes
+    multi_motion = Motion(
+        [displacement, -displacement[:100]], [temporal_bins_s, temporal_bins_s[:100]], motion.spatial_bins_um
+    )
+    disp1 = multi_motion.get_displacement_at_time_and_depth(times_s[:10], locations_um[:10], segment_index=1)
+    np.testing.assert_allclose(disp1, -disp0[:10])
+    disp_all = multi_motion.get_displacement_at_time_and_depth_all_segments(
+        times_s[:10], locations_um[:10], np.ones(10, dtype="int64")
+    )
+    np.testing.assert_allclose(disp_all, -disp0[:10], rtol=0, atol=1e-10)
 
 
 if __name__ == "__main__":
@@ -3,6 +3,13 @@ import warnings
 import numpy as np
 from spikeinterface.core.core_tools import check_json
 
+try:
+    import numba
+
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
 
 def get_spatial_windows(
     contact_depths,
@@ -84,24 +91,25 @@ def get_spatial_windows(
             )
         border = ((max_ - min_) % win_step_um) / 2
         window_centers = np.arange(num_windows + 1) * win_step_um + min_ + border
-        windows = []
-
-        for win_center in window_centers:
-            if win_shape == "gaussian":
-                win = np.exp(-((spatial_bin_centers - win_center) ** 2) / (2 * win_scale_um**2))
-            elif win_shape == "rect":
-                win = np.abs(spatial_bin_centers - win_center) < (win_scale_um / 2.0)
-                win = win.astype("float64")
-            elif win_shape == "triangle":
-                center_dist = np.abs(spatial_bin_centers - win_center)
-                in_window = center_dist <= (win_scale_um / 2.0)
-                win = -center_dist
-                win[~in_window] = 0
-                win[in_window] -= win[in_window].min()
-                win[in_window] /= win[in_window].max()
-            windows.append(win)
-
-    windows = np.array(windows)
+        # distance of each spatial bin to each window center, shape (num_windows, n)
+        center_dist = spatial_bin_centers[np.newaxis, :] - window_centers[:, np.newaxis]
+        if win_shape == "gaussian":
+            windows = np.exp(-(center_dist**2) / (2 * win_scale_um**2))
+        elif win_shape == "rect":
+            windows = np.abs(center_dist) < (win_scale_um / 2.0)
+            windows = windows.astype("float64")
+        elif win_shape == "triangle":
+            center_dist = np.abs(center_dist)
+            in_window = center_dist <= (win_scale_um / 2.0)
+            if not np.all(np.any(in_window, axis=1)):
+                raise ValueError(
+                    f"get_spatial_windows(): some triangle windows contain no spatial bin, {win_scale_um=} is too small"
+                )
+            # rescale to [0, 1] using the min/max distance inside each window
+            max_dist = np.max(center_dist, axis=1, where=in_window, initial=-np.inf, keepdims=True)
+            min_dist = np.min(center_dist, axis=1, where=in_window, initial=np.inf, keepdims=True)
+            windows = np.zeros(center_dist.shape, dtype="float64")
+            np.divide(max_dist - center_dist, max_dist - min_dist, out=windows, where=in_window)
 
     if zero_threshold is not None:
         windows[windows < zero_threshold] = 0
@@ -119,6 +127,13 @@ def get_rigid_windows(spatial_bin_centers):
 
 def get_window_domains(windows):
     """Array of windows -> list of slices where window > 0."""
+    if HAVE_NUMBA:
+        domains = _get_window_domains_numba(np.ascontiguousarray(windows))
+        if np.any(domains[:, 0] < 0):
+            # same error as the numpy version
+            raise IndexError("get_window_domains(): some windows are zero everywhere")
+        return [slice(start, stop) for start, stop in domains]
+
     slices = []
     for w in windows:
         in_window = np.flatnonzero(w)
@@ -126,31 +141,61 @@ def get_window_domains(windows):
     return slices
 
 
+if HAVE_NUMBA:
+
+    @numba.jit(nopython=True, nogil=True, cache=True)
+    def _get_window_domains_numba(windows):
+        """
+        Start/stop of the nonzero domain of each window, without materializing the nonzero indices.
+        Start is -1 when a window is zero everywhere.
+        """
+        num_windows, n = windows.shape
+        domains = np.full((num_windows, 2), -1, dtype=np.int64)
+        for i in range(num_windows):
+            for j in range(n):
+                if windows[i, j] != 0:
+                    domains[i, 0] = j
+                    break
+            for j in range(n - 1, -1, -1):
+                if windows[i, j] != 0:
+                    domains[i, 1] = j + 1
+                    break
+        return domains
+
+
 def scipy_conv1d(input, weights, padding="valid"):
     """SciPy translation of torch F.conv1d"""
-    from scipy.signal import correlate
-
     n, c_in, length = input.shape
     c_out, in_by_groups, kernel_size = weights.shape
     assert in_by_groups == c_in == 1
 
     if padding == "same":
-        mode = "same"
+        # same alignment as scipy.signal.correlate(..., mode="same")
         length_out = length
+        start = (kernel_size - 1) // 2
+        input = np.pad(input, [*[(0, 0)] * (input.ndim - 1), (kernel_size - 1 - start, start)])
     elif padding == "valid":
-        mode = "valid"
         length_out = length - 2 * (kernel_size // 2)
     elif isinstance(padding, int):
-        mode = "valid"
         input = np.pad(input, [*[(0, 0)] * (input.ndim - 1), (padding, padding)])
         length_out = length - (kernel_size - 1) + 2 * padding
     else:
         raise ValueError(f"Unknown 'padding' value of {padding}, 'padding' must be 'same', 'valid' or an integer")
 
+    # direct "valid" correlation of all (input, kernel) pairs at once, looping over the shortest of the
+    # kernel and output axes. Unlike an FFT, sums of zeros stay exactly zero and integers stay exact,
+    # which callers like dredge.normxcorr1d() rely on.
+    x = input[:, 0, :]
+    w = weights[:, 0, :]
     output = np.zeros((n, c_out, length_out), dtype=input.dtype)
-    for m in range(n):
-        for c in range(c_out):
-            output[m, c] = correlate(input[m, 0], weights[c, 0], mode=mode)
+    if kernel_size <= length_out:
+        acc = np.zeros((n, c_out, length_out), dtype=np.result_type(input, weights))
+        for k in range(kernel_size):
+            acc += x[:, np.newaxis, k : k + length_out] * w[np.newaxis, :, k, np.newaxis]
+        output[:] = acc
+    else:
+        for i in range(length_out):
+            output[:, :, i] = x[:, i : i + kernel_size] @ w.T
 
     return output
 
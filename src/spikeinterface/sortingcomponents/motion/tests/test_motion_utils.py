@@ -0,0 +1,116 @@
+import numpy as np
+import pytest
+from scipy.signal import correlate
+
+from spikeinterface.sortingcomponents.motion import dredge, motion_utils
+from spikeinterface.sortingcomponents.motion.motion_utils import get_spatial_windows, get_window_domains, scipy_conv1d
+
+
+def reference_conv1d(input, weights, padding="valid"):
+    # per row scipy.signal.correlate loop
+    kernel_size = weights.shape[2]
+    if padding == "same":
+        mode = "same"
+        length_out = input.shape[2]
+    elif padding == "valid":
+        mode = "valid"
+        length_out = input.shape[2] - 2 * (kernel_size // 2)
+    else:
+        mode = "valid"
+        input = np.pad(input, [(0, 0), (0, 0), (padding, padding)])
+        length_out = input.shape[2] - (kernel_size - 1)
+    output = np.zeros((input.shape[0], weights.shape[0], length_out), dtype=input.dtype)
+    for m in range(input.shape[0]):
+        for c in range(weights.shape[0]):
+            output[m, c] = correlate(input[m, 0], weights[c, 0], mode=mode)
+    return output
+
+
+# kernels shorter and longer than the output (as in compute_pairwise_displacement with a small padding)
+@pytest.mark.parametrize(
+    "padding,kernel_size", [("same", 7), ("valid", 7), (3, 7), (40, 7), ("valid", 49), (2, 31), (5, 31)]
+)
+def test_scipy_conv1d(padding, kernel_size):
+    rng = np.random.default_rng(seed=0)
+    input = rng.normal(size=(4, 1, 50))
+    weights = rng.normal(size=(3, 1, kernel_size))
+    np.testing.assert_allclose(
+        scipy_conv1d(input, weights, padding=padding), reference_conv1d(input, weights, padding=padding), atol=1e-12
+    )
+
+    # integers are exact
+    input = rng.integers(0, 5, size=(4, 1, 50))
+    weights = rng.integers(0, 5, size=(3, 1, kernel_size))
+    np.testing.assert_array_equal(
+        scipy_conv1d(input, weights, padding=padding), reference_conv1d(input, weights, padding=padding)
+    )
+
+
+def test_normxcorr1d_masked(monkeypatch):
+    rng = np.random.default_rng(seed=0)
+    template = rng.normal(size=(10, 60))
+    x = rng.normal(size=(10, 60))
+    xmasks = np.ones_like(x)
+    # the first lags only see masked samples: the counts must be exactly zero
+    xmasks[:, :40] = 0.0
+
+    corr = dredge.normxcorr1d(template, x, xmasks=xmasks, padding=30, conv_engine="numpy")
+    monkeypatch.setattr(dredge, "scipy_conv1d", reference_conv1d)
+    expected = dredge.normxcorr1d(template, x, xmasks=xmasks, padding=30, conv_engine="numpy")
+
+    np.testing.assert_allclose(corr, expected, atol=1e-10)
+    assert np.all(corr[:, :, :10] == 0.0)
+    assert np.all(np.abs(corr) <= 1.0 + 1e-10)
+
+
+@pytest.mark.parametrize("win_shape", ["gaussian", "rect", "triangle"])
+def test_get_spatial_windows(win_shape):
+    contact_depths = np.arange(0.0, 400.0, 20.0)
+    spatial_bin_centers = np.arange(-50.0, 450.0, 5.0)
+    windows, window_centers = get_spatial_windows(
+        contact_depths, spatial_bin_centers, win_shape=win_shape, win_step_um=50.0, win_scale_um=150.0
+    )
+    assert windows.shape == (window_centers.size, spatial_bin_centers.size)
+
+    # one window at a time
+    for win, win_center in zip(windows, window_centers):
+        if win_shape == "gaussian":
+            expected = np.exp(-((spatial_bin_centers - win_center) ** 2) / (2 * 150.0**2))
+        elif win_shape == "rect":
+            expected = (np.abs(spatial_bin_centers - win_center) < 75.0).astype("float64")
+        elif win_shape == "triangle":
+            center_dist = np.abs(spatial_bin_centers - win_center)
+            in_window = center_dist <= 75.0
+            expected = -center_dist
+            expected[~in_window] = 0
+            expected[in_window] -= expected[in_window].min()
+            expected[in_window] /= expected[in_window].max()
+        np.testing.assert_allclose(win, expected, rtol=0, atol=1e-12)
+
+
+def test_get_spatial_windows_empty_triangle():
+    # no spatial bin within win_scale_um / 2 of some window centers
+    with pytest.raises(ValueError):
+        get_spatial_windows(
+            np.arange(0.0, 400.0, 20.0),
+            np.arange(-50.0, 450.0, 40.0),
+            win_shape="triangle",
+            win_step_um=10.0,
+            win_scale_um=5.0,
+        )
+
+
+@pytest.mark.parametrize("have_numba", [motion_utils.HAVE_NUMBA, False])
+def test_get_window_domains(monkeypatch, have_numba):
+    monkeypatch.setattr(motion_utils, "HAVE_NUMBA", have_numba)
+    windows, _ = get_spatial_windows(
+        np.arange(0.0, 400.0, 20.0), np.arange(-50.0, 450.0, 5.0), win_shape="rect", win_scale_um=150.0
+    )
+    domains = get_window_domains(windows)
+    for win, domain in zip(windows, domains):
+        nonzero = np.flatnonzero(win)
+        assert domain == slice(nonzero[0], nonzero[-1] + 1)
+
+    windows[1] = 0.0
+    with pytest.raises(IndexError):
+        get_window_domains(windows)